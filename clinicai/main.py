@@ -5,18 +5,25 @@ Baseado no clinicai_whatsapp.py funcionando, mas com MongoDB
 """
 
 import os
-import json
+import re
+import sys
+import time
 import hashlib
 import asyncio
 import logging
+import functools
+import unicodedata
+from collections import OrderedDict, deque
+from itertools import islice
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Deque, Iterable, Sequence, Final, TypedDict
 
 import uvicorn
 import httpx
+import orjson
 from fastapi import FastAPI, HTTPException, Request, Query
-from fastapi.responses import PlainTextResponse, JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import PlainTextResponse, JSONResponse, ORJSONResponse
+from pydantic import BaseModel
 from dotenv import load_dotenv
 # MongoTriageDatabase está definida neste arquivo
 
@@ -40,9 +47,37 @@ WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID", "fake_id")
 WHATSAPP_VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "ClinicAI_Test_Token_123")
 PHONE_HASH_SALT = os.getenv("PHONE_HASH_SALT", "ClinicAI_Salt_2024")
 
+# Gemini - limite de chamadas simultâneas (alinhado à cota da API)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+
+# Limite de sessões com histórico em memória (LRU)
+MAX_CONVERSATION_SESSIONS = int(os.getenv("MAX_CONVERSATION_SESSIONS", "10000"))
+# Mensagens mantidas por sessão (buffer circular)
+HISTORY_MAX_MESSAGES = 12
+
 # MongoDB
 MONGODB_URI = os.getenv("MONGODB_URI")
 MONGODB_DB = os.getenv("MONGODB_DB", "clinicai_db")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "200"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "10"))
+# Espera (ms) pela seleção do servidor - o padrão do driver tolera cold start de Atlas/SRV
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "30000"))
+# Gravação de mensagens em lote: janela de agrupamento (s) e tamanho máximo do lote
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.05"))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "100"))
+# Validade (s) da triagem ativa em cache por usuário
+TRIAGE_CACHE_TTL = float(os.getenv("TRIAGE_CACHE_TTL", "60"))
+
+# Change stream de triagens: backoff (s) entre tentativas de reabrir o stream
+WATCH_RETRY_MIN_DELAY = 1.0
+WATCH_RETRY_MAX_DELAY = 60.0
+# Códigos de erro do servidor: sem replica set / resume token fora do oplog
+CHANGE_STREAM_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# Reentregas do webhook: message_ids já recebidos, lembrados por este tempo (s)
+SEEN_MESSAGE_TTL = 600
+SEEN_MESSAGE_MAX = 5000
 
 # Log das configurações carregadas
 logger.info("🔧 Configurações carregadas:")
@@ -57,12 +92,35 @@ logger.info(f"   MongoDB URI: {'✅ Configurado' if MONGODB_URI else '❌ Não c
 
 try:
     from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo import ReturnDocument
+    from pymongo.errors import OperationFailure
     MONGODB_AVAILABLE = True
     logger.info("✅ Motor (MongoDB driver) disponível")
 except ImportError:
     MONGODB_AVAILABLE = False
     logger.warning("❌ Motor não disponível - usando fallback")
 
+# Busca multi-padrão (Aho-Corasick) para palavras-chave de emergência - opcional
+try:
+    import ahocorasick_rs
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+# Event loop em C (libuv) quando disponível - vem com uvicorn[standard]
+try:
+    import uvloop  # noqa: F401
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
+# Parser HTTP em C para o uvicorn - opcional (incluído em uvicorn[standard])
+try:
+    import httptools  # noqa: F401
+    HTTPTOOLS_AVAILABLE = True
+except ImportError:
+    HTTPTOOLS_AVAILABLE = False
+
 # Cliente MongoDB global
 mongo_client = None
 mongo_db = None
@@ -76,21 +134,44 @@ async def connect_mongodb():
         return False
     
     try:
-        mongo_client = AsyncIOMotorClient(MONGODB_URI)
-        mongo_db = mongo_client[MONGODB_DB]
+        # Pool compartilhado por todas as corrotinas: conexões mantidas aquecidas e
+        # fila de espera limitada para não acumular requisições quando o pool esgota
+        client = AsyncIOMotorClient(
+            MONGODB_URI,
+            maxPoolSize=MONGODB_MAX_POOL_SIZE,
+            minPoolSize=MONGODB_MIN_POOL_SIZE,
+            maxIdleTimeMS=60000,
+            waitQueueTimeoutMS=5000,
+            serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+            retryWrites=True
+        )
         
         # Testar conexão
-        await mongo_client.admin.command('ping')
-        logger.info(f"✅ MongoDB conectado: {MONGODB_DB}")
+        try:
+            await client.admin.command('ping')
+        except Exception:
+            client.close()
+            raise
         
-        # Criar índices básicos
-        await mongo_db.messages.create_index("phone_hash")
-        await mongo_db.triages.create_index("phone_hash")
+        # Globais só definidos após o ping: sem conexão, a aplicação fica inteira em modo fallback
+        mongo_client = client
+        mongo_db = client[MONGODB_DB]
+        logger.info("✅ MongoDB conectado: %s", MONGODB_DB)
+        
+        # Índices compostos na mesma ordem dos filtros/ordenações do caminho quente:
+        # - mensagens por usuário, mais recentes primeiro (get_messages / get_messages_since)
+        # - triagem ativa por usuário e status (get_active_triage / upsert da triagem)
+        # - mensagem por message_id e direção (deduplicação de reentregas do webhook)
+        await asyncio.gather(
+            mongo_db.messages.create_index([("phone_hash", 1), ("timestamp", -1)]),
+            mongo_db.messages.create_index([("message_id", 1), ("direction", 1)]),
+            mongo_db.triages.create_index([("phone_hash", 1), ("status", 1), ("last_activity", -1)])
+        )
         
         return True
         
     except Exception as e:
-        logger.error(f"❌ Erro MongoDB: {e}")
+        logger.error("❌ Erro MongoDB: %s", e)
         return False
 
 async def disconnect_mongodb():
@@ -104,9 +185,23 @@ async def disconnect_mongodb():
 # MODELOS DE DADOS
 # ================================
 
-class IncomingWhatsAppPayload(BaseModel):
-    object: str
-    entry: List[Dict[str, Any]]
+# Mensagem recebida do webhook, já extraída do payload (dict simples, sem validação Pydantic)
+IncomingMessage = TypedDict("IncomingMessage", {
+    "from": str,
+    "id": str,
+    "text": str,
+    "timestamp": Optional[str]
+})
+
+# Ordem de coleta dos slots
+SLOT_ORDER = (
+    "chief_complaint",      # 1. Qual a sua queixa?
+    "symptoms",             # 2. Pode descrever tudo que você está sentindo...
+    "duration_frequency",   # 3. Desde quando... e com que frequência...
+    "intensity",            # 4. Qual a intensidade da dor (0-10)...
+    "measures_taken",       # 5. Você já fez algo para aliviar...
+    "health_history"        # 6. Você tem algum histórico de saúde...
+)
 
 class TriageSlots(BaseModel):
     """Slots de informações para triagem médica - ordem específica."""
@@ -118,22 +213,18 @@ class TriageSlots(BaseModel):
     health_history: Optional[str] = None      # 6. Você tem algum histórico de saúde...
 
     def is_complete(self) -> bool:
-        return all(getattr(self, field) is not None for field in self.__class__.model_fields.keys())
+        return self.get_next_slot_to_collect() is None
 
     def get_missing_slots(self) -> List[str]:
-        return [field for field in self.__class__.model_fields.keys() if getattr(self, field) is None]
+        return [slot for slot in SLOT_ORDER if getattr(self, slot) is None]
+    
+    def count_filled_slots(self) -> int:
+        """Quantidade de slots preenchidos (sem serializar o modelo)."""
+        return sum(1 for slot in SLOT_ORDER if getattr(self, slot) is not None)
     
     def get_next_slot_to_collect(self) -> Optional[str]:
         """Retorna o próximo slot a ser coletado seguindo a ordem específica."""
-        priority_order = [
-            "chief_complaint",      # 1. Qual a sua queixa?
-            "symptoms",             # 2. Pode descrever tudo que você está sentindo...
-            "duration_frequency",   # 3. Desde quando... e com que frequência...
-            "intensity",            # 4. Qual a intensidade da dor (0-10)...
-            "measures_taken",       # 5. Você já fez algo para aliviar...
-            "health_history"        # 6. Você tem algum histórico de saúde...
-        ]
-        for slot in priority_order:
+        for slot in SLOT_ORDER:
             if getattr(self, slot) is None:
                 return slot
         return None
@@ -145,6 +236,188 @@ class TriageSlots(BaseModel):
 class MongoTriageDatabase:
     """Banco de dados MongoDB para triagens."""
     
+    # Campos da mensagem usados para remontar o histórico da conversa
+    HISTORY_PROJECTION = {"_id": 0, "direction": 1, "text": 1}
+    
+    # Campos da triagem usados pelo processador (leituras e documento devolvido nos upserts)
+    TRIAGE_PROJECTION = {
+        "_id": 0,
+        "status": 1,
+        "slots": 1,
+        "emergency_flag": 1,
+        "created_at": 1,
+        "last_activity": 1,
+        "completed_at": 1
+    }
+    
+    def __init__(self):
+        # Fila de mensagens drenada em lote por _flush_loop (ativa após start_writer)
+        self._pending: Optional[asyncio.Queue] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        # Triagem ativa por phone_hash: (expira_em, documento ou None), em ordem LRU
+        self._triage_cache: OrderedDict[str, tuple] = OrderedDict()
+        self._watch_task: Optional[asyncio.Task] = None
+    
+    def _cache_triage(self, phone_hash: str, triage: Optional[Dict]):
+        """Guarda o estado da triagem ativa (None = sem triagem ativa)."""
+        if triage is not None and triage.get("status") in ("completed", "timeout"):
+            triage = None
+        self._triage_cache[phone_hash] = (time.monotonic() + TRIAGE_CACHE_TTL, triage)
+        self._triage_cache.move_to_end(phone_hash)
+        while len(self._triage_cache) > MAX_CONVERSATION_SESSIONS:
+            self._triage_cache.popitem(last=False)
+    
+    def start_writer(self):
+        """Inicia a gravação em lote das mensagens (chamado no startup)."""
+        if self._flush_task is None:
+            self._pending = asyncio.Queue()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def stop_writer(self):
+        """Grava o que restou na fila e encerra o loop de gravação."""
+        if self._flush_task is None:
+            return
+        self._pending.put_nowait(None)
+        await self._flush_task
+        self._flush_task = None
+        self._pending = None
+    
+    async def _flush_loop(self):
+        """Agrupa mensagens de webhooks concorrentes num único insert_many."""
+        queue = self._pending
+        running = True
+        while running:
+            batch = [await queue.get()]
+            # Janela curta para acumular mensagens de outros turnos no mesmo lote
+            await asyncio.sleep(MESSAGE_FLUSH_INTERVAL)
+            while len(batch) < MESSAGE_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            
+            # None sinaliza o encerramento (stop_writer)
+            if None in batch:
+                running = False
+                batch = [document for document in batch if document is not None]
+                while not queue.empty():
+                    document = queue.get_nowait()
+                    if document is not None:
+                        batch.append(document)
+            
+            await self.save_messages(batch)
+    
+    def start_triage_watch(self):
+        """Inicia o change stream que mantém o cache de triagens coerente (chamado no startup)."""
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch_triages())
+    
+    async def stop_triage_watch(self):
+        """Encerra o change stream de triagens."""
+        if self._watch_task is None:
+            return
+        self._watch_task.cancel()
+        await asyncio.gather(self._watch_task, return_exceptions=True)
+        self._watch_task = None
+    
+    async def _watch_triages(self):
+        """Atualiza o cache com gravações de triagens feitas por outros workers/réplicas.
+        
+        Falhas transitórias (rede, eleição de primário) reabrem o stream com backoff a partir
+        do último resume token; só um MongoDB sem replica set encerra o watcher.
+        """
+        projection = {f"fullDocument.{field}": 1 for field in self.TRIAGE_PROJECTION if field != "_id"}
+        projection["fullDocument.phone_hash"] = 1
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}},
+            {"$project": projection}
+        ]
+        resume_token = None
+        delay = WATCH_RETRY_MIN_DELAY
+        
+        while True:
+            try:
+                async with mongo_db.triages.watch(
+                    pipeline, full_document="updateLookup", resume_after=resume_token
+                ) as stream:
+                    logger.info("👀 Change stream de triagens ativo")
+                    delay = WATCH_RETRY_MIN_DELAY
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        triage = change.get("fullDocument")
+                        if not triage:
+                            continue
+                        
+                        # Só usuários já em cache: o change stream não deve encher o cache do worker
+                        phone_hash = triage.pop("phone_hash", None)
+                        if phone_hash in self._triage_cache:
+                            self._cache_triage(phone_hash, triage)
+                            
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    # MongoDB standalone (sem replica set): o cache segue valendo só pelo TTL
+                    logger.warning("⚠️ Change stream de triagens indisponível: %s", e)
+                    return
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    # Token fora do oplog: as mudanças perdidas não chegam mais, recomeça do zero
+                    resume_token = None
+                    self._triage_cache.clear()
+                logger.warning("⚠️ Change stream de triagens interrompido: %s (nova tentativa em %.0fs)", e, delay)
+            except Exception as e:
+                logger.warning("⚠️ Change stream de triagens interrompido: %s (nova tentativa em %.0fs)", e, delay)
+            
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WATCH_RETRY_MAX_DELAY)
+    
+    async def queue_messages(self, documents: List[Dict]) -> bool:
+        """Enfileira mensagens para o próximo lote; sem o loop ativo, grava direto."""
+        if self._pending is None:
+            return await self.save_messages(documents)
+        for document in documents:
+            self._pending.put_nowait(document)
+        return True
+    
+    @staticmethod
+    def build_message(phone_hash: str, direction: str, message_id: str,
+                      text: str, meta: Dict = None) -> Dict:
+        """Monta o documento de mensagem (timestamp = momento da chamada)."""
+        return {
+            "phone_hash": phone_hash,
+            "direction": direction,
+            "message_id": message_id,
+            "text": text,
+            "timestamp": datetime.now(),
+            "meta": meta or {}
+        }
+    
+    @staticmethod
+    def _build_triage_upsert(phone_hash: str, slots: TriageSlots = None,
+                             status: str = "open", emergency_flag: bool = False,
+                             last_activity: datetime = None, completed_at: datetime = None) -> tuple:
+        """Monta filtro e update do upsert da triagem ativa (datas como datetime, BSON nativo)."""
+        now = datetime.now()
+        update_data = {
+            "status": status,
+            "emergency_flag": emergency_flag,
+            "last_activity": last_activity or now
+        }
+        
+        if slots:
+            update_data["slots"] = slots.model_dump()
+        
+        if completed_at:
+            update_data["completed_at"] = completed_at
+        
+        return (
+            {"phone_hash": phone_hash, "status": {"$nin": ["completed", "timeout"]}},
+            {
+                "$set": update_data,
+                "$setOnInsert": {
+                    "phone_hash": phone_hash,
+                    "created_at": now
+                }
+            }
+        )
+    
     async def save_message(self, phone_hash: str, direction: str, message_id: str, 
                           text: str, meta: Dict = None) -> bool:
         """Salva mensagem no MongoDB."""
@@ -152,25 +425,27 @@ class MongoTriageDatabase:
             logger.warning("⚠️ MongoDB não conectado")
             return False
         
+        document = self.build_message(phone_hash, direction, message_id, text, meta)
+        logger.info("💾 Mensagem MongoDB: %s (%s)", message_id, direction)
+        return await self.queue_messages([document])
+    
+    async def has_message(self, message_id: str, direction: str) -> bool:
+        """Verifica se a mensagem já foi gravada (consulta coberta pelo índice de message_id)."""
+        if mongo_db is None:
+            return False
+        
         try:
-            document = {
-                "phone_hash": phone_hash,
-                "direction": direction,
-                "message_id": message_id,
-                "text": text,
-                "timestamp": datetime.now(),
-                "meta": meta or {}
-            }
-            
-            result = await mongo_db.messages.insert_one(document)
-            logger.info(f"💾 Mensagem MongoDB: {message_id} ({direction})")
-            return bool(result.inserted_id)
+            found = await mongo_db.messages.find_one(
+                {"message_id": message_id, "direction": direction},
+                projection={"_id": 0, "message_id": 1}
+            )
+            return found is not None
             
         except Exception as e:
-            logger.error(f"❌ Erro ao salvar mensagem: {e}")
+            logger.error("❌ Erro ao verificar mensagem: %s", e)
             return False
     
-    async def get_messages(self, phone_hash: str, limit: int = 20) -> List[Dict]:
+    async def get_messages(self, phone_hash: str, limit: int = 20, projection: Dict = None) -> List[Dict]:
         """Busca mensagens de um usuário."""
         if mongo_db is None:
             logger.warning("⚠️ MongoDB não conectado")
@@ -178,24 +453,26 @@ class MongoTriageDatabase:
         
         try:
             cursor = mongo_db.messages.find(
-                {"phone_hash": phone_hash}
+                {"phone_hash": phone_hash}, projection=projection
             ).sort("timestamp", -1).limit(limit)
             
             messages = await cursor.to_list(length=limit)
             
             # Converter ObjectId para string e timestamps
             for msg in messages:
-                msg["_id"] = str(msg["_id"])
+                if "_id" in msg:
+                    msg["_id"] = str(msg["_id"])
                 if isinstance(msg.get("timestamp"), datetime):
                     msg["timestamp"] = msg["timestamp"].isoformat()
             
             return messages
             
         except Exception as e:
-            logger.error(f"❌ Erro ao buscar mensagens: {e}")
+            logger.error("❌ Erro ao buscar mensagens: %s", e)
             return []
     
-    async def get_messages_since(self, phone_hash: str, since_timestamp: datetime, limit: int = 50) -> List[Dict]:
+    async def get_messages_since(self, phone_hash: str, since_timestamp: datetime, limit: int = 50,
+                                 projection: Dict = None) -> List[Dict]:
         """Busca mensagens do MongoDB a partir de um timestamp específico."""
         if mongo_db is None:
             logger.warning("⚠️ MongoDB não conectado")
@@ -206,195 +483,272 @@ class MongoTriageDatabase:
             if isinstance(since_timestamp, str):
                 since_timestamp = datetime.fromisoformat(since_timestamp.replace('Z', '+00:00'))
             
-            cursor = mongo_db.messages.find({
-                "phone_hash": phone_hash,
-                "timestamp": {"$gte": since_timestamp}
-            }).sort("timestamp", -1).limit(limit)
+            cursor = mongo_db.messages.find(
+                {"phone_hash": phone_hash, "timestamp": {"$gte": since_timestamp}},
+                projection=projection
+            ).sort("timestamp", -1).limit(limit)
             
             messages = await cursor.to_list(length=limit)
             
             # Converter ObjectId para string e timestamps
             for msg in messages:
-                msg["_id"] = str(msg["_id"])
+                if "_id" in msg:
+                    msg["_id"] = str(msg["_id"])
                 if isinstance(msg.get("timestamp"), datetime):
                     msg["timestamp"] = msg["timestamp"].isoformat()
             
-            logger.info(f"📊 Encontradas {len(messages)} mensagens desde {since_timestamp} para {phone_hash[:8]}...")
+            logger.info("📊 Encontradas %d mensagens desde %s para %.8s...", len(messages), since_timestamp, phone_hash)
             return messages
             
         except Exception as e:
-            logger.error(f"❌ Erro ao buscar mensagens desde timestamp: {e}")
+            logger.error("❌ Erro ao buscar mensagens desde timestamp: %s", e)
             return []
     
     async def create_or_update_triage(self, phone_hash: str, slots: TriageSlots = None, 
                                     status: str = "open", emergency_flag: bool = False,
-                                    last_activity: str = None, completed_at: str = None) -> bool:
+                                    last_activity: datetime = None, completed_at: datetime = None) -> bool:
         """Cria ou atualiza triagem no MongoDB."""
         if mongo_db is None:
             logger.warning("⚠️ MongoDB não conectado")
             return False
         
         try:
-            update_data = {
-                "status": status,
-                "emergency_flag": emergency_flag,
-                "last_activity": datetime.fromisoformat(last_activity) if last_activity else datetime.now()
-            }
+            triage_filter, triage_update = self._build_triage_upsert(
+                phone_hash, slots, status, emergency_flag, last_activity, completed_at
+            )
+            # find_one_and_update devolve o documento gravado: o cache fica exato, sem nova leitura
+            triage = await mongo_db.triages.find_one_and_update(
+                triage_filter, triage_update, upsert=True,
+                projection=self.TRIAGE_PROJECTION, return_document=ReturnDocument.AFTER
+            )
+            self._cache_triage(phone_hash, triage)
             
-            if slots:
-                update_data["slots"] = slots.model_dump()
+            logger.info("💾 Triagem MongoDB salva: %.8s... (%s)", phone_hash, status)
+            return True
             
-            if completed_at:
-                update_data["completed_at"] = datetime.fromisoformat(completed_at)
+        except Exception as e:
+            logger.error("❌ Erro ao salvar triagem: %s", e)
+            return False
+    
+    async def save_messages(self, documents: List[Dict]) -> bool:
+        """Salva várias mensagens num único insert_many."""
+        if mongo_db is None:
+            logger.warning("⚠️ MongoDB não conectado")
+            return False
+        
+        if not documents:
+            return True
+        
+        try:
+            result = await mongo_db.messages.insert_many(documents, ordered=False)
+            logger.info("💾 Mensagens MongoDB: %d salvas", len(result.inserted_ids))
+            return True
             
-            result = await mongo_db.triages.update_one(
-                {"phone_hash": phone_hash, "status": {"$ne": "completed"}},
-                {
-                    "$set": update_data,
-                    "$setOnInsert": {
-                        "phone_hash": phone_hash,
-                        "created_at": datetime.now()
-                    }
-                },
-                upsert=True
+        except Exception as e:
+            logger.error("❌ Erro ao salvar mensagens: %s", e)
+            return False
+    
+    async def save_turn(self, phone_hash: str, messages: List[Dict], slots: TriageSlots = None,
+                        status: str = "open", emergency_flag: bool = False,
+                        last_activity: datetime = None, completed_at: datetime = None) -> bool:
+        """Persiste um turno: upsert da triagem; mensagens vão para o lote em andamento."""
+        if mongo_db is None:
+            logger.warning("⚠️ MongoDB não conectado")
+            return False
+        
+        try:
+            triage_filter, triage_update = self._build_triage_upsert(
+                phone_hash, slots, status, emergency_flag, last_activity, completed_at
             )
-            
-            action = "criada" if result.upserted_id else "atualizada"
-            logger.info(f"💾 Triagem MongoDB {action}: {phone_hash[:8]}... ({status})")
+            # Estado do turno visível no cache antes do primeiro await: o próximo turno do
+            # mesmo usuário já parte destes slots, mesmo com a gravação ainda em andamento
+            cached = self._triage_cache.get(phone_hash)
+            if cached is not None and cached[1] is not None:
+                self._cache_triage(phone_hash, {**cached[1], **triage_update["$set"]})
+            
+            if messages:
+                await self.queue_messages(messages)
+            triage = await mongo_db.triages.find_one_and_update(
+                triage_filter, triage_update, upsert=True,
+                projection=self.TRIAGE_PROJECTION, return_document=ReturnDocument.AFTER
+            )
+            self._cache_triage(phone_hash, triage)
+            logger.info("💾 Turno MongoDB: %.8s... (%s, %d mensagens)", phone_hash, status, len(messages))
             return True
             
         except Exception as e:
-            logger.error(f"❌ Erro ao salvar triagem: {e}")
+            logger.error("❌ Erro ao salvar turno: %s", e)
             return False
     
-    async def get_active_triage(self, phone_hash: str) -> Optional[Dict]:
-        """Busca triagem ativa no MongoDB."""
+    async def get_active_triage(self, phone_hash: str, now: datetime = None,
+                                idle_timeout: timedelta = None) -> Optional[Dict]:
+        """Busca triagem ativa no MongoDB.
+        
+        Com idle_timeout, a triagem parada há mais tempo que isso é encerrada como "timeout"
+        na mesma operação (find_one_and_update) e devolvida com esse status.
+        """
         if mongo_db is None:
             return None
         
+        now = now or datetime.now()
+        
+        # Sessão ativa: estado mantido a cada gravação, sem ida ao MongoDB por turno
+        cached = self._triage_cache.get(phone_hash)
+        if cached is not None and cached[0] > time.monotonic():
+            triage = cached[1]
+            last_activity = triage.get("last_activity") if triage else None
+            if idle_timeout is None or last_activity is None or now - last_activity <= idle_timeout:
+                self._triage_cache.move_to_end(phone_hash)
+                return triage
+        
+        active_filter = {"phone_hash": phone_hash, "status": {"$nin": ["completed", "timeout"]}}
+        
         try:
-            triage = await mongo_db.triages.find_one({
-                "phone_hash": phone_hash,
-                "status": {"$nin": ["completed", "timeout"]}
-            })
-            
-            if triage:
-                # Converter datas para string
-                for field in ["created_at", "last_activity", "completed_at"]:
-                    if triage.get(field):
-                        triage[field] = triage[field].isoformat()
+            if idle_timeout is None:
+                triage = await mongo_db.triages.find_one(active_filter, projection=self.TRIAGE_PROJECTION)
+            else:
+                # Leitura e expiração atômicas: sem corrida entre buscar, decidir e gravar o timeout
+                expired = {"$lt": ["$last_activity", now - idle_timeout]}
+                triage = await mongo_db.triages.find_one_and_update(
+                    active_filter,
+                    [{"$set": {
+                        "status": {"$cond": [expired, "timeout", "$status"]},
+                        "completed_at": {"$cond": [expired, now, "$$REMOVE"]}
+                    }}],
+                    projection=self.TRIAGE_PROJECTION,
+                    return_document=ReturnDocument.AFTER
+                )
+            self._cache_triage(phone_hash, triage)
             
+            # Datas mantidas como datetime (BSON nativo): o timeout compara direto, sem parse ISO
             return triage
             
         except Exception as e:
-            logger.error(f"❌ Erro ao buscar triagem: {e}")
+            logger.error("❌ Erro ao buscar triagem: %s", e)
             return None
     
-    async def get_triage_slots(self, phone_hash: str) -> TriageSlots:
-        """Busca slots de triagem do MongoDB."""
-        triage = await self.get_active_triage(phone_hash)
+    @staticmethod
+    def slots_from_triage(triage: Optional[Dict]) -> TriageSlots:
+        """Monta os slots a partir de um documento de triagem já carregado.
         
+        Os slots gravados vêm do próprio model_dump(): dados confiáveis, montados sem revalidar.
+        """
         if triage and triage.get("slots"):
             try:
-                return TriageSlots(**triage["slots"])
+                return TriageSlots.model_construct(**triage["slots"])
             except Exception as e:
-                logger.error(f"❌ Erro ao carregar slots: {e}")
+                logger.error("❌ Erro ao carregar slots: %s", e)
         
         return TriageSlots()
+    
+    async def get_triage_slots(self, phone_hash: str) -> TriageSlots:
+        """Busca slots de triagem do MongoDB."""
+        return self.slots_from_triage(await self.get_active_triage(phone_hash))
 
 # ================================
 # UTILITÁRIOS
 # ================================
 
+# Tudo que não é dígito (removido numa única passada em C)
+_NON_DIGITS = re.compile(r"\D")
+
+# Mesmo tamanho nos dois caches: cada turno passa pelos dois com o mesmo telefone
+_PHONE_CACHE_SIZE = 50000
+
+@functools.lru_cache(maxsize=_PHONE_CACHE_SIZE)
 def extract_phone_from_whatsapp(whatsapp_phone: str) -> str:
     """Extrai número limpo do formato WhatsApp."""
-    return ''.join(filter(str.isdigit, whatsapp_phone))
+    return _NON_DIGITS.sub("", whatsapp_phone)
+
+# Salt codificado uma única vez (o hash é sha256(telefone + salt), compatível com os já gravados)
+_PHONE_HASH_SALT_BYTES = PHONE_HASH_SALT.encode()
 
+@functools.lru_cache(maxsize=_PHONE_CACHE_SIZE)
 def hash_phone_number(phone: str) -> str:
-    """Gera hash do número de telefone."""
-    return hashlib.sha256(f"{phone}{PHONE_HASH_SALT}".encode()).hexdigest()
+    """Gera hash do número de telefone (memoizado: o mesmo número repete a cada turno)."""
+    return hashlib.sha256(phone.encode() + _PHONE_HASH_SALT_BYTES).hexdigest()
 
 # ================================
 # WHATSAPP CLIENT
 # ================================
 
+# Corpo JSON da mensagem de texto montado por partes: só destinatário e texto variam
+_TEXT_BODY_PREFIX = b'{"messaging_product":"whatsapp","type":"text","to":'
+_TEXT_BODY_MIDDLE = b',"text":{"body":'
+_TEXT_BODY_SUFFIX = b'}}'
+
 class WhatsAppClient:
-    """Cliente para envio de mensagens WhatsApp."""
+    """Cliente para envio de mensagens WhatsApp (uma instância por processo: whatsapp_client)."""
+    
+    def __init__(self):
+        # Endpoint de envio montado uma vez
+        self._send_url = f"https://graph.facebook.com/v20.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
+        # Cliente HTTP compartilhado: HTTP/2 multiplexa os envios em poucas conexões TLS;
+        # cabeçalho de autorização definido uma vez no cliente, não a cada envio
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+            timeout=10.0,
+            headers={
+                "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}",
+                "Content-Type": "application/json"
+            }
+        )
+    
+    async def aclose(self):
+        """Fecha as conexões com a API do WhatsApp."""
+        await self.http_client.aclose()
     
     @staticmethod
-    def parse_incoming_message(payload: Dict) -> Optional[Dict]:
+    def parse_incoming_message(payload: Dict) -> Optional[IncomingMessage]:
         """Parse de mensagem recebida."""
+        # Indexação direta num único try: payloads sem mensagem (ex.: status de entrega) caem no except
         try:
-            if not payload.get("entry"):
-                return None
-            
-            entry = payload["entry"][0]
-            changes = entry.get("changes", [])
-            
-            if not changes:
-                return None
-            
-            change = changes[0]
-            if change.get("field") != "messages":
-                return None
-            
-            value = change.get("value", {})
-            messages = value.get("messages", [])
-            
-            if not messages:
+            change = payload["entry"][0]["changes"][0]
+            if change["field"] != "messages":
                 return None
             
-            message = messages[0]
+            message = change["value"]["messages"][0]
+            text = message.get("text")
             
             return {
-                "from": message.get("from"),
-                "id": message.get("id"),
-                "text": message.get("text", {}).get("body", ""),
+                "from": message["from"],
+                "id": message["id"],
+                "text": text.get("body", "") if text else "",
                 "timestamp": message.get("timestamp")
             }
             
-        except Exception as e:
-            logger.error(f"❌ Erro ao fazer parse da mensagem: {e}")
+        except (KeyError, IndexError, TypeError):
             return None
     
-    @staticmethod
-    async def send_text_message(to: str, text: str) -> Optional[str]:
+    async def send_text_message(self, to: str, text: str) -> Optional[str]:
         """Envia mensagem de texto via WhatsApp."""
         if WHATSAPP_ACCESS_TOKEN == "fake_token":
-            logger.warning(f"⚠️ WhatsApp fake mode: {text[:50]}...")
+            logger.warning("⚠️ WhatsApp fake mode: %.50s...", text)
             return f"fake_msg_{datetime.now().timestamp()}"
         
         try:
-            url = f"https://graph.facebook.com/v20.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-            
-            headers = {
-                "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}",
-                "Content-Type": "application/json"
-            }
+            encoded_text = _ENCODED_STATIC_TEXTS.get(text) or orjson.dumps(text)
+            body = b"".join((_TEXT_BODY_PREFIX, orjson.dumps(to), _TEXT_BODY_MIDDLE, encoded_text, _TEXT_BODY_SUFFIX))
             
-            data = {
-                "messaging_product": "whatsapp",
-                "to": to,
-                "type": "text",
-                "text": {"body": text}
-            }
+            response = await self.http_client.post(self._send_url, content=body)
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=data, headers=headers, timeout=10.0)
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    message_id = result.get("messages", [{}])[0].get("id")
-                    logger.info(f"✅ WhatsApp enviado: {message_id}")
-                    return message_id
-                else:
-                    logger.error(f"❌ WhatsApp API error: {response.status_code} - {response.text}")
-                    return None
+            if response.status_code == 200:
+                result = response.json()
+                message_id = result.get("messages", [{}])[0].get("id")
+                logger.info("✅ WhatsApp enviado: %s", message_id)
+                return message_id
+            else:
+                logger.error("❌ WhatsApp API error: %s - %s", response.status_code, response.text)
+                return None
                     
         except Exception as e:
-            logger.error(f"❌ Erro ao enviar WhatsApp: {e}")
+            logger.error("❌ Erro ao enviar WhatsApp: %s", e)
             return None
 
+# Instância única: todos os envios reaproveitam o mesmo pool de conexões
+whatsapp_client = WhatsAppClient()
+
 # ================================
 # GEMINI INTEGRATION
 # ================================
@@ -402,20 +756,24 @@ class WhatsAppClient:
 class GeminiTriageAgent:
     """Agente Gemini para triagem conversacional natural."""
     
-    def __init__(self):
-        self.client = None
-        if GEMINI_API_KEY and GEMINI_API_KEY != "fake_key_for_testing":
-            try:
-                import google.generativeai as genai
-                genai.configure(api_key=GEMINI_API_KEY)
-                self.client = genai.GenerativeModel("gemini-2.5-pro")
-                logger.info("✅ Gemini configurado")
-            except Exception as e:
-                logger.error(f"❌ Erro Gemini: {e}")
+    # Configurações de segurança mais permissivas (apenas categorias válidas)
+    SAFETY_SETTINGS = [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
+    ]
     
-    def _get_system_prompt(self) -> str:
-        """Retorna o prompt do sistema para o agente de triagem."""
-        return """Você é um assistente virtual de triagem. Sua missão é conduzir uma conversa acolhedora e empática para coletar informações que ajudem a agilizar o atendimento médico do usuário.
+    # Configurações de geração otimizadas
+    GENERATION_CONFIG = {
+        "temperature": 0.3,  # Mais determinístico
+        "max_output_tokens": 400,
+        "top_p": 0.8,
+        "top_k": 40,
+        "candidate_count": 1
+    }
+    
+    SYSTEM_PROMPT = """Você é um assistente virtual de triagem. Sua missão é conduzir uma conversa acolhedora e empática para coletar informações que ajudem a agilizar o atendimento médico do usuário.
 
 PERSONA E COMPORTAMENTO:
 - Seja acolhedor, empático, calmo e profissional
@@ -457,36 +815,11 @@ SEMPRE RESPONDA EM JSON:
   "is_complete": false,
   "next_focus": "próximo dado ou null"
 }"""
-
-    async def process_conversation(self, user_message: str, current_slots: TriageSlots, conversation_history: List[str] = None) -> Dict[str, Any]:
-        """Processa conversa e coleta informações de triagem."""
-        if not self.client:
-            # Fallback sem Gemini
-            return self._fallback_response(user_message, current_slots, conversation_history)
-        
-        try:
-            # Construir contexto da conversa
-            history_text = ""
-            if conversation_history:
-                history_text = "\n".join(conversation_history[-6:])  # Últimas 6 mensagens
-            
-            # Informações já coletadas
-            collected_info = {
-                "chief_complaint": current_slots.chief_complaint,
-                "symptoms": current_slots.symptoms,
-                "duration_frequency": current_slots.duration_frequency,
-                "intensity": current_slots.intensity,
-                "history": current_slots.health_history,
-                "measures_taken": current_slots.measures_taken
-            }
-            
-            # Verificar se é início da conversa
-            is_conversation_start = user_message == "[INÍCIO DA CONVERSA]"
-            
-            if is_conversation_start:
-                user_prompt = f"""
+    
+    # Templates dos prompts do usuário, montados uma vez e renderizados com str.format_map
+    START_PROMPT_TEMPLATE = """
 CONTEXTO DA CONVERSA:
-{history_text}
+{history}
 
 SITUAÇÃO: Este é o INÍCIO de uma nova triagem. O usuário acabou de receber a mensagem de boas-vindas.
 
@@ -498,13 +831,13 @@ INSTRUÇÕES:
 
 IMPORTANTE: Esta é a PRIMEIRA pergunta da triagem. Seja acolhedor e direto.
 """
-            else:
-                user_prompt = f"""
+    
+    TURN_PROMPT_TEMPLATE = """
 CONTEXTO DA CONVERSA:
-{history_text}
+{history}
 
 INFORMAÇÕES JÁ COLETADAS:
-{json.dumps(collected_info, indent=2, ensure_ascii=False)}
+{collected_info}
 
 NOVA MENSAGEM DO USUÁRIO:
 "{user_message}"
@@ -519,32 +852,80 @@ INSTRUÇÕES:
 
 Se todas as 6 informações estiverem coletadas, marque "is_complete": true e faça um resumo acolhedor.
 """
-
-            import asyncio
-            
-            # Configurações de segurança mais permissivas (apenas categorias válidas)
-            safety_settings = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
-            ]
+    
+    # Perguntas do modo fallback (sem Gemini), por slot
+    FALLBACK_QUESTIONS = {
+        "chief_complaint": "Para começarmos, pode me contar qual é o motivo do seu contato hoje?",
+        "symptoms": "Entendi. Agora pode me descrever com mais detalhes tudo o que você está sentindo?",
+        "duration_frequency": "Obrigada por compartilhar. Desde quando você está sentindo isso e com que frequência acontece?",
+        "intensity": "Compreendo. Em uma escala de 0 a 10, onde 0 é sem dor e 10 é uma dor insuportável, como você classificaria a intensidade?",
+        "measures_taken": "Entendo. Você já tentou fazer alguma coisa para aliviar esses sintomas?",
+        "health_history": "Por último, você tem algum histórico de saúde que considera relevante compartilhar?"
+    }
+    FALLBACK_CLOSING = "Obrigada por todas as informações. Um profissional analisará seu caso e você receberá retorno em breve."
+    
+    def __init__(self):
+        self.client = None
+        self._semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+        # Respostas de abertura por prompt: o início da conversa parte sempre do mesmo
+        # histórico (boas-vindas), então o prompt se repete idêntico para todo novo usuário
+        self._start_responses: Dict[str, Dict[str, Any]] = {}
+        if GEMINI_API_KEY and GEMINI_API_KEY != "fake_key_for_testing":
+            try:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                # Prompt do sistema como system_instruction: prefixo estável entre chamadas,
+                # elegível ao cache implícito do Gemini; cada chamada envia só o contexto do turno
+                self.client = genai.GenerativeModel("gemini-2.5-pro", system_instruction=self.SYSTEM_PROMPT)
+                logger.info("✅ Gemini configurado")
+            except Exception as e:
+                logger.error("❌ Erro Gemini: %s", e)
+    
+    async def process_conversation(self, user_message: str, current_slots: TriageSlots, conversation_history: Sequence[str] = None) -> Dict[str, Any]:
+        """Processa conversa e coleta informações de triagem."""
+        if not self.client:
+            # Fallback sem Gemini
+            return self._fallback_response(user_message, current_slots, conversation_history)
+        
+        try:
+            # Construir contexto da conversa
+            history_text = ""
+            if conversation_history:
+                # Últimas 6 mensagens (islice: o histórico é um deque, sem fatiamento)
+                history_text = "\n".join(islice(conversation_history, max(0, len(conversation_history) - 6), None))
             
-            # Configurações de geração otimizadas
-            generation_config = {
-                "temperature": 0.3,  # Mais determinístico
-                "max_output_tokens": 400,
-                "top_p": 0.8,
-                "top_k": 40,
-                "candidate_count": 1
-            }
+            # Verificar se é início da conversa
+            is_conversation_start = user_message == "[INÍCIO DA CONVERSA]"
             
-            response = await asyncio.to_thread(
-                self.client.generate_content,
-                f"{self._get_system_prompt()}\n\n{user_prompt}",
-                generation_config=generation_config,
-                safety_settings=safety_settings
-            )
+            if is_conversation_start:
+                user_prompt = self.START_PROMPT_TEMPLATE.format_map({"history": history_text})
+                cached = self._start_responses.get(user_prompt)
+                if cached is not None:
+                    return dict(cached)
+            else:
+                # Informações já coletadas
+                collected_info = {
+                    "chief_complaint": current_slots.chief_complaint,
+                    "symptoms": current_slots.symptoms,
+                    "duration_frequency": current_slots.duration_frequency,
+                    "intensity": current_slots.intensity,
+                    "history": current_slots.health_history,
+                    "measures_taken": current_slots.measures_taken
+                }
+                
+                user_prompt = self.TURN_PROMPT_TEMPLATE.format_map({
+                    "history": history_text,
+                    "collected_info": orjson.dumps(collected_info, option=orjson.OPT_INDENT_2).decode(),
+                    "user_message": user_message
+                })
+
+            # API assíncrona nativa do SDK: roda no próprio loop, sem thread por chamada
+            async with self._semaphore:
+                response = await self.client.generate_content_async(
+                    user_prompt,
+                    generation_config=self.GENERATION_CONFIG,
+                    safety_settings=self.SAFETY_SETTINGS
+                )
             
             # Verificar se a resposta foi bloqueada
             if not response.candidates or not response.candidates[0].content.parts:
@@ -561,20 +942,25 @@ Se todas as 6 informações estiverem coletadas, marque "is_complete": true e fa
                 response_text = response_text.replace("```", "").strip()
             
             try:
-                result = json.loads(response_text)
-                logger.info(f"🤖 Gemini processou conversa: {'emergência' if result.get('is_emergency') else 'normal'}")
+                result = orjson.loads(response_text)
+                logger.info("🤖 Gemini processou conversa: %s", "emergência" if result.get("is_emergency") else "normal")
+                
+                if is_conversation_start and result.get("message"):
+                    if len(self._start_responses) >= 32:
+                        self._start_responses.clear()
+                    self._start_responses[user_prompt] = dict(result)
                 return result
                 
-            except json.JSONDecodeError as e:
-                logger.error(f"❌ Erro JSON Gemini: {e}")
-                logger.error(f"📄 Resposta raw: {response_text}")
+            except orjson.JSONDecodeError as e:
+                logger.error("❌ Erro JSON Gemini: %s", e)
+                logger.error("📄 Resposta raw: %s", response_text)
                 return self._fallback_response(user_message, current_slots, conversation_history)
             
         except Exception as e:
-            logger.error(f"❌ Erro processamento Gemini: {e}")
+            logger.error("❌ Erro processamento Gemini: %s", e)
             return self._fallback_response(user_message, current_slots, conversation_history)
     
-    def _fallback_response(self, user_message: str, current_slots: TriageSlots, conversation_history: List[str] = None) -> Dict[str, Any]:
+    def _fallback_response(self, user_message: str, current_slots: TriageSlots, conversation_history: Sequence[str] = None) -> Dict[str, Any]:
         """Resposta fallback quando Gemini não está disponível."""
         # Detectar emergência básica
         emergency_detected = is_emergency(user_message)
@@ -597,42 +983,20 @@ Se todas as 6 informações estiverem coletadas, marque "is_complete": true e fa
         
         # Lógica simples para próxima pergunta
         next_slot = current_slots.get_next_slot_to_collect()
+        updated_slots = current_slots.model_dump()
         
         if next_slot == "chief_complaint":
             if first_question_already_asked:
                 # Se primeira pergunta já foi feita, assumir que usuário está respondendo
-                message = "Entendi. Agora pode me descrever com mais detalhes tudo o que você está sentindo?"
-                # Atualizar slots com a resposta do usuário
-                updated_slots = current_slots.model_dump()
                 updated_slots["chief_complaint"] = user_message.strip()
                 # Avançar para próximo slot
                 next_slot = "symptoms"
-            else:
-                message = "Para começarmos, pode me contar qual é o motivo do seu contato hoje?"
-                updated_slots = current_slots.model_dump()
-        elif next_slot == "symptoms":
-            message = "Entendi. Agora pode me descrever com mais detalhes tudo o que você está sentindo?"
-            updated_slots = current_slots.model_dump()
-            updated_slots[next_slot] = user_message.strip()
-        elif next_slot == "duration_frequency":
-            message = "Obrigada por compartilhar. Desde quando você está sentindo isso e com que frequência acontece?"
-            updated_slots = current_slots.model_dump()
-            updated_slots[next_slot] = user_message.strip()
-        elif next_slot == "intensity":
-            message = "Compreendo. Em uma escala de 0 a 10, onde 0 é sem dor e 10 é uma dor insuportável, como você classificaria a intensidade?"
-            updated_slots = current_slots.model_dump()
-            updated_slots[next_slot] = user_message.strip()
-        elif next_slot == "measures_taken":
-            message = "Entendo. Você já tentou fazer alguma coisa para aliviar esses sintomas?"
-            updated_slots = current_slots.model_dump()
-            updated_slots[next_slot] = user_message.strip()
-        elif next_slot == "health_history":
-            message = "Por último, você tem algum histórico de saúde que considera relevante compartilhar?"
-            updated_slots = current_slots.model_dump()
+            message = self.FALLBACK_QUESTIONS[next_slot]
+        elif next_slot:
+            message = self.FALLBACK_QUESTIONS[next_slot]
             updated_slots[next_slot] = user_message.strip()
         else:
-            message = "Obrigada por todas as informações. Um profissional analisará seu caso e você receberá retorno em breve."
-            updated_slots = current_slots.model_dump()
+            message = self.FALLBACK_CLOSING
         
         return {
             "message": message,
@@ -646,9 +1010,44 @@ Se todas as 6 informações estiverem coletadas, marque "is_complete": true e fa
 # CONVERSATION HELPER
 # ================================
 
+_WELCOME_MESSAGE: Final[str] = """🏥 *Olá! Sou seu assistente virtual e vou ajudar a organizar suas informações para agilizar seu atendimento."""
+
+# Resposta a mensagens sem texto (áudio, imagem, figurinha), sem passar pelo Gemini
+_TEXT_ONLY_MESSAGE: Final[str] = "Por enquanto consigo entender apenas mensagens de texto. Pode me responder escrevendo, por favor?"
+
+# Rótulos do resumo final, na mesma ordem de SLOT_ORDER
+_SUMMARY_LABELS: Final = (
+    "Queixa",
+    "Sintomas",
+    "Duração/Frequência",
+    "Intensidade",
+    "Medidas tomadas",
+    "Histórico de saúde"
+)
+
+_COMPLETION_TEMPLATE: Final[str] = """🎉 **Triagem Concluída com Sucesso!**
+
+Registrei todas as suas informações:
+
+{summary}
+
+✅ **Próximos passos:**
+• Um profissional da nossa clínica analisará seu caso
+• Você receberá retorno em breve
+• Suas informações estão seguras e organizadas
+
+💙 Obrigada pela colaboração! Desejamos sua melhora!
+
+📞 *Em caso de emergência, ligue 192 ou procure o pronto-socorro mais próximo.*"""
+
+# Mensagens fixas efetivamente enviadas, codificadas em JSON uma única vez para o corpo do envio
+_ENCODED_STATIC_TEXTS: Final[Dict[str, bytes]] = {
+    text: orjson.dumps(text) for text in (_WELCOME_MESSAGE, _TEXT_ONLY_MESSAGE)
+}
+
 def get_welcome_message() -> str:
     """Mensagem de boas-vindas inicial."""
-    return """🏥 *Olá! Sou seu assistente virtual e vou ajudar a organizar suas informações para agilizar seu atendimento."""
+    return _WELCOME_MESSAGE
 
 # ================================
 # EMERGENCY DETECTION
@@ -663,18 +1062,47 @@ EMERGENCY_KEYWORDS = [
     "emergência", "urgente", "hospital", "ambulancia", "192"
 ]
 
+def _fold_text(text: str) -> str:
+    """Minúsculas (casefold) e sem acentos ("Emergência" -> "emergencia")."""
+    folded = text.casefold()
+    if folded.isascii():
+        return folded
+    # Remove só as marcas combinantes (acentos): emojis e outros símbolos continuam
+    # separando as letras, sem juntar palavras-chave ("av😀c" não vira "avc")
+    return "".join(
+        char for char in unicodedata.normalize("NFKD", folded) if not unicodedata.combining(char)
+    )
+
+# Palavras-chave já normalizadas, na mesma ordem de EMERGENCY_KEYWORDS
+_EMERGENCY_KEYWORDS_FOLDED = [_fold_text(keyword) for keyword in EMERGENCY_KEYWORDS]
+
+# Autômato Aho-Corasick: uma única passada pelo texto para todas as palavras-chave
+_EMERGENCY_AUTOMATON = (
+    ahocorasick_rs.AhoCorasick(_EMERGENCY_KEYWORDS_FOLDED, matchkind=ahocorasick_rs.MatchKind.LeftmostFirst)
+    if AHOCORASICK_AVAILABLE else None
+)
+
+# Fallback sem Aho-Corasick: uma alternação compilada, varrida em C pelo módulo re
+_EMERGENCY_PATTERN = re.compile("|".join(map(re.escape, _EMERGENCY_KEYWORDS_FOLDED)))
+
 def is_emergency(text: str) -> bool:
     """Detecta emergências."""
-    text_lower = text.lower()
-    for keyword in EMERGENCY_KEYWORDS:
-        if keyword in text_lower:
-            logger.warning(f"🚨 Emergência detectada: {keyword}")
+    text_folded = _fold_text(text)
+    
+    if _EMERGENCY_AUTOMATON is not None:
+        matches = _EMERGENCY_AUTOMATON.find_matches_as_indexes(text_folded)
+        if matches:
+            logger.warning("🚨 Emergência detectada: %s", EMERGENCY_KEYWORDS[matches[0][0]])
             return True
+        return False
+    
+    match = _EMERGENCY_PATTERN.search(text_folded)
+    if match:
+        logger.warning("🚨 Emergência detectada: %s", match.group(0))
+        return True
     return False
 
-def get_emergency_response() -> str:
-    """Resposta para emergências."""
-    return """🚨 **ATENÇÃO - SITUAÇÃO DE EMERGÊNCIA DETECTADA**
+_EMERGENCY_RESPONSE: Final[str] = """🚨 **ATENÇÃO - SITUAÇÃO DE EMERGÊNCIA DETECTADA**
 
 Sua situação parece ser urgente. Por favor:
 
@@ -687,6 +1115,10 @@ Sua situação parece ser urgente. Por favor:
 
 💙 Este é um assistente virtual e não substitui atendimento médico urgente."""
 
+def get_emergency_response() -> str:
+    """Resposta para emergências."""
+    return _EMERGENCY_RESPONSE
+
 # ================================
 # PROCESSADOR PRINCIPAL
 # ================================
@@ -697,33 +1129,99 @@ class TriageProcessor:
     def __init__(self):
         self.db = MongoTriageDatabase()
         self.gemini = GeminiTriageAgent()
-        self.conversation_histories = {}
+        # Históricos por phone_hash, do menos ao mais recentemente usado (LRU)
+        self.conversation_histories: OrderedDict[str, Deque[str]] = OrderedDict()
+        # Último uso de cada histórico (time.monotonic), para descartar sessões ociosas
+        self._history_touched: Dict[str, float] = {}
         self.TIMEOUT_MINUTES = 30
+        # Gravações em segundo plano (referência mantida até concluírem)
+        self._background_tasks: set = set()
+        # Um turno por vez para cada usuário: phone_hash -> [lock, turnos usando/aguardando]
+        self._locks: Dict[str, list] = {}
+        # message_id -> expira_em, em ordem de chegada
+        self._seen_message_ids: OrderedDict[str, float] = OrderedDict()
     
-    def _check_timeout(self, last_activity: datetime) -> bool:
-        """Verifica timeout."""
-        now = datetime.now()
-        time_diff = now - last_activity
-        return time_diff.total_seconds() > (self.TIMEOUT_MINUTES * 60)
+    def _is_duplicate(self, message_id: str) -> bool:
+        """Registra o message_id; True se ele já foi recebido dentro do SEEN_MESSAGE_TTL."""
+        now = time.monotonic()
+        seen = self._seen_message_ids
+        while seen and (len(seen) > SEEN_MESSAGE_MAX or next(iter(seen.values())) <= now):
+            seen.popitem(last=False)
+        
+        if message_id in seen:
+            return True
+        seen[message_id] = now + SEEN_MESSAGE_TTL
+        return False
+    
+    def _run_in_background(self, coro) -> asyncio.Task:
+        """Agenda uma corrotina sem bloquear a resposta do webhook."""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
+    async def drain_background_tasks(self):
+        """Aguarda as gravações pendentes (usado no shutdown)."""
+        if self._background_tasks:
+            logger.info("⏳ Aguardando %d gravações pendentes...", len(self._background_tasks))
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+    
+    def _set_history(self, phone_hash: str, messages: Iterable[str] = ()) -> Deque[str]:
+        """Define o histórico da sessão e descarta as sessões menos usadas acima do limite."""
+        history = deque(messages, maxlen=HISTORY_MAX_MESSAGES)
+        self.conversation_histories[phone_hash] = history
+        self.conversation_histories.move_to_end(phone_hash)
+        self._history_touched[phone_hash] = time.monotonic()
+        while len(self.conversation_histories) > MAX_CONVERSATION_SESSIONS:
+            evicted, _ = self.conversation_histories.popitem(last=False)
+            self._history_touched.pop(evicted, None)
+        return history
+    
+    def _touch_history(self, phone_hash: str) -> Optional[Deque[str]]:
+        """Retorna o histórico da sessão em memória (None se fria) e o marca como recente."""
+        self._expire_idle_histories()
+        history = self.conversation_histories.get(phone_hash)
+        if history is None:
+            return None
+        self.conversation_histories.move_to_end(phone_hash)
+        self._history_touched[phone_hash] = time.monotonic()
+        return history
     
-    async def _load_conversation_history(self, phone_hash: str):
+    def _drop_history(self, phone_hash: str):
+        """Libera o histórico da sessão da memória."""
+        self.conversation_histories.pop(phone_hash, None)
+        self._history_touched.pop(phone_hash, None)
+    
+    def _expire_idle_histories(self):
+        """Descarta, a partir do início do LRU, as sessões paradas além do timeout."""
+        deadline = time.monotonic() - self.TIMEOUT_MINUTES * 60
+        histories = self.conversation_histories
+        while histories:
+            oldest = next(iter(histories))
+            if self._history_touched.get(oldest, 0.0) > deadline:
+                break
+            self._drop_history(oldest)
+    
+    async def _load_conversation_history(self, phone_hash: str, current_triage: Optional[Dict]) -> Deque[str]:
         """Carrega histórico apenas da triagem atual do MongoDB."""
         try:
-            # Buscar triagem ativa para obter created_at
-            current_triage = await self.db.get_active_triage(phone_hash)
+            # Triagem ativa (já buscada pelo chamador) fornece o created_at
             if not current_triage:
-                self.conversation_histories[phone_hash] = []
-                return
+                return self._set_history(phone_hash)
             
             triage_start = current_triage.get('created_at')
             if not triage_start:
                 # Fallback para últimas mensagens se não tiver created_at
-                messages = await self.db.get_messages(phone_hash, limit=10)
-                logger.info(f"📚 Usando fallback: últimas 10 mensagens para {phone_hash[:8]}...")
+                messages = await self.db.get_messages(
+                    phone_hash, limit=10, projection=self.db.HISTORY_PROJECTION
+                )
+                logger.info("📚 Usando fallback: últimas 10 mensagens para %.8s...", phone_hash)
             else:
                 # Buscar mensagens apenas a partir do início da triagem atual
-                messages = await self.db.get_messages_since(phone_hash, triage_start, limit=30)
-                logger.info(f"📚 Carregando mensagens desde {triage_start} para {phone_hash[:8]}...")
+                messages = await self.db.get_messages_since(
+                    phone_hash, triage_start, limit=30, projection=self.db.HISTORY_PROJECTION
+                )
+                logger.info("📚 Carregando mensagens desde %s para %.8s...", triage_start, phone_hash)
             
             # Reconstruir histórico em ordem cronológica
             history = []
@@ -732,107 +1230,143 @@ class TriageProcessor:
                 text = msg.get("text", "")
                 
                 if direction == "in":
-                    history.append(f"Usuário: {text}")
+                    # Mensagens sem texto (mídia) ficam gravadas só para deduplicação
+                    if text:
+                        history.append(f"Usuário: {text}")
                 elif direction == "out":
                     history.append(f"ClinicAI: {text}")
             
             # Atualizar histórico na memória
-            self.conversation_histories[phone_hash] = history
-            
-            logger.info(f"📚 Histórico da triagem atual carregado: {phone_hash[:8]}... ({len(history)} mensagens)")
+            logger.info("📚 Histórico da triagem atual carregado: %.8s... (%d mensagens)", phone_hash, len(history))
+            return self._set_history(phone_hash, history)
             
         except Exception as e:
-            logger.error(f"❌ Erro ao carregar histórico da triagem: {e}")
+            logger.error("❌ Erro ao carregar histórico da triagem: %s", e)
             # Manter histórico vazio em caso de erro
-            self.conversation_histories[phone_hash] = []
+            return self._set_history(phone_hash)
     
     async def process_message(self, phone: str, message_text: str, message_id: str = None) -> Dict[str, Any]:
+        """Processa mensagem: ignora reentregas do webhook e serializa os turnos de cada usuário."""
+        if message_id and self._is_duplicate(message_id):
+            logger.info("🔁 Mensagem repetida ignorada: %s", message_id)
+            return {"success": True, "status": "duplicate"}
+        
+        phone_hash = hash_phone_number(extract_phone_from_whatsapp(phone))
+        entry = self._locks.get(phone_hash)
+        if entry is None:
+            entry = self._locks[phone_hash] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        
+        try:
+            async with entry[0]:
+                return await self._process_turn(phone, message_text, message_id)
+        finally:
+            # Último turno do usuário saindo: o lock ocioso é descartado
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[phone_hash]
+    
+    async def _process_turn(self, phone: str, message_text: str, message_id: str = None) -> Dict[str, Any]:
         """Processa mensagem com conversa natural Gemini."""
         try:
+            # Relógio do turno: timeout, last_activity, completed_at e ids de fallback. Os timestamps
+            # das mensagens e o created_at da triagem leem o relógio no momento da gravação
+            now = datetime.now()
+            
+            # Normalizar o texto uma única vez na entrada (NFKC + strip): o mesmo valor
+            # segue para histórico, MongoDB e Gemini
+            message_text = unicodedata.normalize("NFKC", message_text).strip()
+            
             # Normalizar telefone
             normalized_phone = extract_phone_from_whatsapp(phone)
             phone_hash = hash_phone_number(normalized_phone)
             
-            logger.info(f"💬 Conversando: {phone_hash[:8]}... - '{message_text[:30]}...'")
-            
-            # Inicializar histórico se não existir
-            if phone_hash not in self.conversation_histories:
-                self.conversation_histories[phone_hash] = []
+            short_hash = phone_hash[:8]
+            logger.info("💬 Conversando: %s... - '%.30s...'", short_hash, message_text)
             
-            # Buscar triagem ativa
-            current_triage = await self.db.get_active_triage(phone_hash)
+            # Histórico da sessão em memória, referenciado localmente no turno (None = sessão fria)
+            history = self._touch_history(phone_hash)
             
-            # Verificar timeout e carregar histórico se há triagem ativa
-            if current_triage:
-                last_activity_str = current_triage.get('last_activity')
-                if last_activity_str:
-                    try:
-                        last_activity = datetime.fromisoformat(last_activity_str)
-                        if self._check_timeout(last_activity):
-                            logger.info(f"⏰ Timeout detectado: {phone_hash[:8]}...")
-                            await self.db.create_or_update_triage(
-                                phone_hash=phone_hash,
-                                status="timeout",
-                                completed_at=datetime.now().isoformat()
-                            )
-                            # Limpar histórico
-                            self.conversation_histories[phone_hash] = []
-                            current_triage = None
-                        else:
-                            # Carregar histórico completo do MongoDB se triagem ativa
-                            await self._load_conversation_history(phone_hash)
-                    except:
-                        pass
+            # Buscar triagem ativa (parada além do limite: encerrada como timeout pelo MongoDB)
+            active_triage = self.db.get_active_triage(
+                phone_hash, now=now, idle_timeout=timedelta(minutes=self.TIMEOUT_MINUTES)
+            )
+            if message_id and history is None:
+                # Sessão fria (restart, LRU): reentrega já gravada só é reconhecível no MongoDB,
+                # consultado junto com a triagem. Sessão quente: _seen_message_ids já cobre
+                current_triage, already_stored = await asyncio.gather(
+                    active_triage, self.db.has_message(message_id, "in")
+                )
+                if already_stored:
+                    logger.info("🔁 Mensagem já registrada ignorada: %s", message_id)
+                    return {"success": True, "status": "duplicate"}
+            else:
+                current_triage = await active_triage
+            
+            if current_triage and current_triage.get("status") == "timeout":
+                logger.info("⏰ Timeout detectado: %s...", short_hash)
+                # Sessão expirada: liberar o histórico da memória
+                self._drop_history(phone_hash)
+                current_triage = None
+            elif current_triage and history is None:
+                # Sessão fria (restart, outro worker, LRU): histórico da triagem ativa vem do MongoDB.
+                # Sessão quente: o deque em memória é a fonte da verdade - as respostas do turno
+                # anterior podem ainda estar no lote de gravação e não apareceriam na consulta
+                history = await self._load_conversation_history(phone_hash, current_triage)
             
             # Se não há triagem ativa - iniciar nova
             if not current_triage:
-                await self.db.create_or_update_triage(
-                    phone_hash=phone_hash,
-                    status="open",
-                    last_activity=datetime.now().isoformat()
-                )
-                
-                # Enviar mensagem de boas-vindas
                 welcome_message = get_welcome_message()
                 
-                message_id = await WhatsAppClient.send_text_message(normalized_phone, welcome_message)
-                
-                if message_id:
-                    await self.db.save_message(
-                        phone_hash=phone_hash,
-                        direction="out",
-                        message_id=message_id,
-                        text=welcome_message
-                    )
-                
                 # Limpar e inicializar histórico
-                self.conversation_histories[phone_hash] = []
-                self.conversation_histories[phone_hash].append(f"ClinicAI: {welcome_message}")
+                history = self._set_history(phone_hash, [f"ClinicAI: {welcome_message}"])
                 
-                # Agora fazer Gemini gerar a primeira pergunta
-                logger.info(f"🤖 Gerando primeira pergunta com Gemini...")
+                # Criar triagem, enviar boas-vindas e gerar a primeira pergunta com Gemini
+                # são independentes: rodam em paralelo em vez de somar as latências
+                logger.info("🤖 Gerando primeira pergunta com Gemini...")
                 current_slots = TriageSlots()
                 
-                first_question_result = await self.gemini.process_conversation(
-                    user_message="[INÍCIO DA CONVERSA]",
-                    current_slots=current_slots,
-                    conversation_history=self.conversation_histories[phone_hash]
+                # Mensagem que abriu a triagem também é gravada: uma reentrega dela após um
+                # restart é reconhecida por has_message, não tomada como resposta à 1ª pergunta
+                turn_messages = [self.db.build_message(
+                    phone_hash, "in",
+                    message_id or f"in_{now.timestamp()}",
+                    message_text,
+                    meta={"source": "whatsapp"}
+                )]
+                
+                _, welcome_message_id, first_question_result = await asyncio.gather(
+                    self.db.create_or_update_triage(
+                        phone_hash=phone_hash,
+                        status="open",
+                        last_activity=now
+                    ),
+                    whatsapp_client.send_text_message(normalized_phone, welcome_message),
+                    self.gemini.process_conversation(
+                        user_message="[INÍCIO DA CONVERSA]",
+                        current_slots=current_slots,
+                        conversation_history=list(history)
+                    )
                 )
                 
+                # Mensagens deste turno, gravadas juntas ao final
+                if welcome_message_id:
+                    turn_messages.append(self.db.build_message(phone_hash, "out", welcome_message_id, welcome_message))
+                
                 # Enviar primeira pergunta do Gemini
                 first_question = first_question_result["message"]
-                question_message_id = await WhatsAppClient.send_text_message(normalized_phone, first_question)
+                question_message_id = await whatsapp_client.send_text_message(normalized_phone, first_question)
                 
                 # SEMPRE salvar a primeira pergunta, mesmo se WhatsApp falhar
-                await self.db.save_message(
-                    phone_hash=phone_hash,
-                    direction="out",
-                    message_id=question_message_id or f"out_{datetime.now().timestamp()}",
-                    text=first_question
-                )
-                self.conversation_histories[phone_hash].append(f"ClinicAI: {first_question}")
+                turn_messages.append(self.db.build_message(
+                    phone_hash, "out",
+                    question_message_id or f"out_{now.timestamp()}",
+                    first_question
+                ))
+                self._run_in_background(self.db.queue_messages(turn_messages))
+                history.append(f"ClinicAI: {first_question}")
                 
-                logger.info(f"✅ Primeira pergunta enviada e registrada: '{first_question[:50]}...'")
+                logger.info("✅ Primeira pergunta enviada e registrada: '%.50s...'", first_question)
                 
                 return {
                     "success": True,
@@ -840,51 +1374,69 @@ class TriageProcessor:
                     "phone_hash": phone_hash
                 }
             
+            # Sem texto não há o que extrair: responde direto, sem custo de Gemini
+            if not message_text:
+                # Mensagem recebida também gravada: uma reentrega após restart não gera nova resposta
+                turn_messages = [self.db.build_message(
+                    phone_hash, "in",
+                    message_id or f"in_{now.timestamp()}",
+                    message_text,
+                    meta={"source": "whatsapp"}
+                )]
+                reply_message_id = await whatsapp_client.send_text_message(normalized_phone, _TEXT_ONLY_MESSAGE)
+                if reply_message_id:
+                    turn_messages.append(self.db.build_message(phone_hash, "out", reply_message_id, _TEXT_ONLY_MESSAGE))
+                    history.append(f"ClinicAI: {_TEXT_ONLY_MESSAGE}")
+                self._run_in_background(self.db.queue_messages(turn_messages))
+                return {
+                    "success": True,
+                    "status": "empty_message",
+                    "response_sent": bool(reply_message_id)
+                }
+            
             # Adicionar mensagem do usuário ao histórico
-            self.conversation_histories[phone_hash].append(f"Usuário: {message_text}")
+            history.append(f"Usuário: {message_text}")
             
-            # Salvar mensagem recebida
-            await self.db.save_message(
-                phone_hash=phone_hash,
-                direction="in",
-                message_id=message_id or f"in_{datetime.now().timestamp()}",
-                text=message_text,
+            # Mensagem recebida: gravada já, em paralelo com a chamada ao Gemini
+            self._run_in_background(self.db.queue_messages([self.db.build_message(
+                phone_hash, "in",
+                message_id or f"in_{now.timestamp()}",
+                message_text,
                 meta={"source": "whatsapp"}
-            )
+            )]))
             
-            # Buscar slots atuais
-            current_slots = await self.db.get_triage_slots(phone_hash)
+            # Mensagens de saída deste turno, gravadas junto com a triagem ao final
+            turn_messages = []
+            
+            # Slots atuais a partir da triagem já carregada (sem nova consulta)
+            current_slots = self.db.slots_from_triage(current_triage)
             
             # Processar conversa com Gemini
-            logger.info(f"🤖 Enviando para Gemini: '{message_text[:50]}...'")
+            logger.info("🤖 Enviando para Gemini: '%.50s...'", message_text)
             conversation_result = await self.gemini.process_conversation(
                 user_message=message_text,
                 current_slots=current_slots,
-                conversation_history=self.conversation_histories[phone_hash]
+                conversation_history=history
             )
             
             # Verificar se é emergência
             if conversation_result.get("is_emergency", False):
-                logger.warning(f"🚨 Emergência detectada: {phone_hash[:8]}...")
-                
-                await self.db.create_or_update_triage(
-                    phone_hash=phone_hash,
-                    status="emergency",
-                    emergency_flag=True,
-                    last_activity=datetime.now().isoformat()
-                )
+                logger.warning("🚨 Emergência detectada: %s...", short_hash)
                 
                 emergency_message = conversation_result["message"]
-                message_id = await WhatsAppClient.send_text_message(normalized_phone, emergency_message)
+                message_id = await whatsapp_client.send_text_message(normalized_phone, emergency_message)
                 
                 if message_id:
-                    await self.db.save_message(
-                        phone_hash=phone_hash,
-                        direction="out",
-                        message_id=message_id,
-                        text=emergency_message
-                    )
-                    self.conversation_histories[phone_hash].append(f"ClinicAI: {emergency_message}")
+                    turn_messages.append(self.db.build_message(phone_hash, "out", message_id, emergency_message))
+                    history.append(f"ClinicAI: {emergency_message}")
+                
+                self._run_in_background(self.db.save_turn(
+                    phone_hash=phone_hash,
+                    messages=turn_messages,
+                    status="emergency",
+                    emergency_flag=True,
+                    last_activity=now
+                ))
                 
                 return {
                     "success": True,
@@ -898,41 +1450,33 @@ class TriageProcessor:
             updated_slots = TriageSlots(**collected_info)
             
             # Salvar slots atualizados
-            current_time = datetime.now().isoformat()
             status = "completed" if conversation_result.get("is_complete", False) else "open"
-            completed_at = current_time if status == "completed" else None
-            
-            await self.db.create_or_update_triage(
-                phone_hash=phone_hash,
-                slots=updated_slots,
-                status=status,
-                last_activity=current_time,
-                completed_at=completed_at
-            )
+            completed_at = now if status == "completed" else None
             
             # Enviar resposta do Gemini
             response_message = conversation_result["message"]
-            message_id = await WhatsAppClient.send_text_message(normalized_phone, response_message)
+            message_id = await whatsapp_client.send_text_message(normalized_phone, response_message)
             
             if message_id:
-                await self.db.save_message(
-                    phone_hash=phone_hash,
-                    direction="out",
-                    message_id=message_id,
-                    text=response_message
-                )
-                self.conversation_histories[phone_hash].append(f"ClinicAI: {response_message}")
-                
-                # Manter histórico limitado
-                if len(self.conversation_histories[phone_hash]) > 12:
-                    self.conversation_histories[phone_hash] = self.conversation_histories[phone_hash][-8:]
+                turn_messages.append(self.db.build_message(phone_hash, "out", message_id, response_message))
+                history.append(f"ClinicAI: {response_message}")
+            
+            # Triagem + mensagens do turno numa única rodada de escrita, fora do caminho da resposta
+            self._run_in_background(self.db.save_turn(
+                phone_hash=phone_hash,
+                messages=turn_messages,
+                slots=updated_slots,
+                status=status,
+                last_activity=now,
+                completed_at=completed_at
+            ))
             
             # Log do progresso
-            slots_filled = sum(1 for v in updated_slots.model_dump().values() if v is not None)
-            logger.info(f"📊 Progresso triagem: {slots_filled}/6 slots coletados")
+            slots_filled = updated_slots.count_filled_slots()
+            logger.info("📊 Progresso triagem: %d/6 slots coletados", slots_filled)
             
             if status == "completed":
-                logger.info(f"🎉 Triagem completa: {phone_hash[:8]}...")
+                logger.info("🎉 Triagem completa: %s...", short_hash)
             
             return {
                 "success": True,
@@ -946,50 +1490,25 @@ class TriageProcessor:
             }
             
         except Exception as e:
-            logger.error(f"❌ Erro processamento conversa: {e}")
+            logger.error("❌ Erro processamento conversa: %s", e)
             import traceback
-            logger.error(f"🔍 Traceback: {traceback.format_exc()}")
+            logger.error("🔍 Traceback: %s", traceback.format_exc())
             return {"success": False, "error": str(e)}
     
     async def _get_completion_message(self, slots: TriageSlots) -> str:
         """Mensagem de finalização."""
-        summary_parts = []
-        
-        if slots.chief_complaint:
-            summary_parts.append(f"✓ Queixa: {slots.chief_complaint}")
-        if slots.symptoms:
-            summary_parts.append(f"✓ Sintomas: {slots.symptoms}")
-        if slots.duration_frequency:
-            summary_parts.append(f"✓ Duração/Frequência: {slots.duration_frequency}")
-        if slots.intensity:
-            summary_parts.append(f"✓ Intensidade: {slots.intensity}")
-        if slots.measures_taken:
-            summary_parts.append(f"✓ Medidas tomadas: {slots.measures_taken}")
-        if slots.health_history:
-            summary_parts.append(f"✓ Histórico de saúde: {slots.health_history}")
-        
-        summary = "\n".join(summary_parts)
-        
-        return f"""🎉 **Triagem Concluída com Sucesso!**
-
-Registrei todas as suas informações:
-
-{summary}
-
-✅ **Próximos passos:**
-• Um profissional da nossa clínica analisará seu caso
-• Você receberá retorno em breve
-• Suas informações estão seguras e organizadas
-
-💙 Obrigada pela colaboração! Desejamos sua melhora!
-
-📞 *Em caso de emergência, ligue 192 ou procure o pronto-socorro mais próximo.*"""
+        summary = "\n".join(
+            f"✓ {label}: {value}"
+            for label, value in zip(_SUMMARY_LABELS, (getattr(slots, slot) for slot in SLOT_ORDER))
+            if value
+        )
+        return _COMPLETION_TEMPLATE.format(summary=summary)
 
 # ================================
 # FASTAPI APPLICATION
 # ================================
 
-app = FastAPI(title="ClinicAI MongoDB", version="2.0.0")
+app = FastAPI(title="ClinicAI MongoDB", version="2.0.0", default_response_class=ORJSONResponse)
 
 # Instâncias globais
 triage_processor = TriageProcessor()
@@ -1003,6 +1522,8 @@ async def startup_event():
     mongodb_connected = await connect_mongodb()
     
     if mongodb_connected:
+        triage_processor.db.start_writer()
+        triage_processor.db.start_triage_watch()
         logger.info("✅ ClinicAI MongoDB pronto!")
     else:
         logger.warning("⚠️ ClinicAI iniciado sem MongoDB (modo fallback)")
@@ -1011,6 +1532,10 @@ async def startup_event():
 async def shutdown_event():
     """Shutdown da aplicação."""
     logger.info("🔽 Finalizando ClinicAI...")
+    await triage_processor.drain_background_tasks()
+    await triage_processor.db.stop_triage_watch()
+    await triage_processor.db.stop_writer()
+    await whatsapp_client.aclose()
     await disconnect_mongodb()
 
 @app.get("/health")
@@ -1021,8 +1546,11 @@ async def health_check():
     stats = {"messages": 0, "triages": 0}
     if mongo_db is not None:
         try:
-            stats["messages"] = await mongo_db.messages.count_documents({})
-            stats["triages"] = await mongo_db.triages.count_documents({})
+            # Contagens em paralelo a partir dos metadados da coleção (sem varrer documentos)
+            stats["messages"], stats["triages"] = await asyncio.gather(
+                mongo_db.messages.estimated_document_count(),
+                mongo_db.triages.estimated_document_count()
+            )
         except:
             pass
     
@@ -1041,7 +1569,7 @@ async def verify_whatsapp_webhook(
     hub_challenge: str = Query(alias="hub.challenge"),
 ):
     """Verificação webhook WhatsApp."""
-    logger.info(f"📋 Verificação webhook: {hub_verify_token[:10]}...")
+    logger.info("📋 Verificação webhook: %.10s...", hub_verify_token)
     
     if hub_mode == "subscribe" and hub_verify_token == WHATSAPP_VERIFY_TOKEN:
         logger.info("✅ Webhook verificado!")
@@ -1051,19 +1579,22 @@ async def verify_whatsapp_webhook(
         raise HTTPException(status_code=403, detail="Forbidden")
 
 @app.post("/webhook/whatsapp")
-async def handle_whatsapp_webhook(request: Request, payload: IncomingWhatsAppPayload):
+async def handle_whatsapp_webhook(request: Request):
     """Handler webhook WhatsApp."""
     try:
         logger.info("📱 Webhook recebido")
         
+        # Parse direto do corpo bruto (orjson), sem validação Pydantic no caminho quente
+        payload = orjson.loads(await request.body())
+        
         # Parse mensagem
-        parsed_message = WhatsAppClient.parse_incoming_message(payload.model_dump())
+        parsed_message = WhatsAppClient.parse_incoming_message(payload)
         
         if not parsed_message:
             logger.info("📭 Nenhuma mensagem válida")
             return {"status": "ok"}
         
-        logger.info(f"💬 De: {parsed_message['from'][:8]}... - '{parsed_message['text'][:30]}...'")
+        logger.info("💬 De: %.8s... - '%.30s...'", parsed_message['from'], parsed_message['text'])
         
         # Processar mensagem
         result = await triage_processor.process_message(
@@ -1072,12 +1603,12 @@ async def handle_whatsapp_webhook(request: Request, payload: IncomingWhatsAppPay
             message_id=parsed_message["id"]
         )
         
-        logger.info(f"🎯 Processado: {result.get('success', False)} - {result.get('status', 'unknown')}")
+        logger.info("🎯 Processado: %s - %s", result.get('success', False), result.get('status', 'unknown'))
         
         return {"status": "processed", "result": result}
         
     except Exception as e:
-        logger.error(f"❌ Erro webhook: {e}")
+        logger.error("❌ Erro webhook: %s", e)
         return {"status": "error", "message": str(e)}
 
 # ================================
@@ -1085,26 +1616,39 @@ async def handle_whatsapp_webhook(request: Request, payload: IncomingWhatsAppPay
 # ================================
 
 if __name__ == "__main__":
-    print("=" * 60)
-    print("🏥 CLINICAI MONGODB - SISTEMA DE TRIAGEM")
-    print("=" * 60)
-    print("🚀 Versão: MongoDB 2.0.0 (Corrigida)")
-    print("🌐 Servidor: http://localhost:8080")
-    print("🍃 Database: MongoDB Atlas")
-    print("📱 WhatsApp: /webhook/whatsapp")
-    print("🔍 Health: /health")
-    print("📋 Docs: /docs")
-    print("=" * 60)
-    print("🔧 Configurações:")
-    print(f"   📱 WhatsApp: {'✅' if WHATSAPP_ACCESS_TOKEN != 'fake_token' else '❌'}")
-    print(f"   🔑 Gemini: {'✅' if GEMINI_API_KEY != 'fake_key_for_testing' else '❌'}")
-    print(f"   🍃 MongoDB: {'✅' if MONGODB_URI else '❌'}")
-    print("=" * 60)
+    # Banner montado em memória e emitido numa única escrita
+    banner = [
+        "=" * 60,
+        "🏥 CLINICAI MONGODB - SISTEMA DE TRIAGEM",
+        "=" * 60,
+        "🚀 Versão: MongoDB 2.0.0 (Corrigida)",
+        "🌐 Servidor: http://localhost:8080",
+        "🍃 Database: MongoDB Atlas",
+        "📱 WhatsApp: /webhook/whatsapp",
+        "🔍 Health: /health",
+        "📋 Docs: /docs",
+        "=" * 60,
+        "🔧 Configurações:",
+        f"   📱 WhatsApp: {'✅' if WHATSAPP_ACCESS_TOKEN != 'fake_token' else '❌'}",
+        f"   🔑 Gemini: {'✅' if GEMINI_API_KEY != 'fake_key_for_testing' else '❌'}",
+        f"   🍃 MongoDB: {'✅' if MONGODB_URI else '❌'}",
+        "=" * 60,
+    ]
     
     if WHATSAPP_ACCESS_TOKEN == "fake_token":
-        print("⚠️ ATENÇÃO: Usando credenciais fake!")
-        print("   Configure .env com credenciais reais")
+        banner.append("⚠️ ATENÇÃO: Usando credenciais fake!")
+        banner.append("   Configure .env com credenciais reais")
     
-    print("🚀 Iniciando servidor...")
+    banner.append("🚀 Iniciando servidor...")
+    sys.stdout.write("\n".join(banner) + "\n")
+    sys.stdout.flush()
     
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # Processo único: histórico das sessões, locks por usuário e message_ids já vistos
+    # ficam em memória - vários workers dividiriam os turnos de um mesmo usuário
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8080,
+        loop="uvloop" if UVLOOP_AVAILABLE else "asyncio",
+        http="httptools" if HTTPTOOLS_AVAILABLE else "h11"
+    )
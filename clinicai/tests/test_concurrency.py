@@ -0,0 +1,192 @@
+"""Testes da deduplicação de webhooks, locks por usuário, gravação em lote e cache de triagens."""
+
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import MongoTriageDatabase, TriageProcessor, TriageSlots
+
+PHONE = "5511999990000"
+
+
+@pytest.fixture
+def processor(monkeypatch):
+    """Processador com o turno substituído por um registro das chamadas."""
+    processor = TriageProcessor()
+    processor.turns = []
+    processor.active = 0
+    processor.max_active = 0
+
+    async def fake_turn(phone, message_text, message_id=None):
+        processor.active += 1
+        processor.max_active = max(processor.max_active, processor.active)
+        try:
+            await asyncio.sleep(0.01)
+            if message_text == "falha":
+                raise RuntimeError("falha no turno")
+            processor.turns.append(message_id)
+            return {"success": True, "status": "open"}
+        finally:
+            processor.active -= 1
+
+    monkeypatch.setattr(processor, "_process_turn", fake_turn)
+    return processor
+
+
+class _BlockingTriages:
+    """Coleção de triagens falsa: find_one_and_update só responde quando liberada."""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.calls = 0
+
+    async def find_one_and_update(self, triage_filter, update, **kwargs):
+        self.calls += 1
+        await self.release.wait()
+        return {**update["$set"], **update["$setOnInsert"]}
+
+
+# ================================
+# DEDUPLICAÇÃO
+# ================================
+
+async def test_redelivered_message_is_dropped(processor):
+    first = await processor.process_message(PHONE, "oi", "wamid.1")
+    second = await processor.process_message(PHONE, "oi", "wamid.1")
+
+    assert first["status"] == "open"
+    assert second == {"success": True, "status": "duplicate"}
+    assert processor.turns == ["wamid.1"]
+
+
+async def test_concurrent_redeliveries_run_one_turn(processor):
+    results = await asyncio.gather(
+        *(processor.process_message(PHONE, "oi", "wamid.1") for _ in range(3))
+    )
+
+    assert sorted(result["status"] for result in results) == ["duplicate", "duplicate", "open"]
+    assert processor.turns == ["wamid.1"]
+
+
+async def test_seen_message_ids_are_bounded(processor, monkeypatch):
+    monkeypatch.setattr(main, "SEEN_MESSAGE_MAX", 2)
+
+    for message_id in ("wamid.1", "wamid.2", "wamid.3"):
+        assert not processor._is_duplicate(message_id)
+
+    # O mais antigo saiu do registro: uma nova entrega volta a ser processada
+    assert not processor._is_duplicate("wamid.1")
+    assert processor._is_duplicate("wamid.3")
+
+
+# ================================
+# LOCKS POR USUÁRIO
+# ================================
+
+async def test_turns_of_same_user_are_serialized(processor):
+    await asyncio.gather(
+        *(processor.process_message(PHONE, f"mensagem {i}", f"wamid.{i}") for i in range(3))
+    )
+
+    assert processor.max_active == 1
+    assert processor.turns == ["wamid.0", "wamid.1", "wamid.2"]
+    assert processor._locks == {}
+
+
+async def test_turns_of_different_users_run_in_parallel(processor):
+    await asyncio.gather(
+        processor.process_message("5511999990001", "oi", "wamid.a"),
+        processor.process_message("5511999990002", "oi", "wamid.b")
+    )
+
+    assert processor.max_active == 2
+    assert processor._locks == {}
+
+
+async def test_lock_is_released_when_turn_fails(processor):
+    with pytest.raises(RuntimeError):
+        await processor.process_message(PHONE, "falha", "wamid.1")
+
+    assert processor._locks == {}
+    assert (await processor.process_message(PHONE, "oi", "wamid.2"))["status"] == "open"
+    assert processor._locks == {}
+
+
+# ================================
+# GRAVAÇÃO EM LOTE
+# ================================
+
+async def test_stop_writer_flushes_pending_messages(monkeypatch):
+    db = MongoTriageDatabase()
+    batches = []
+
+    async def fake_save_messages(documents):
+        batches.append(list(documents))
+        return True
+
+    monkeypatch.setattr(db, "save_messages", fake_save_messages)
+    db.start_writer()
+
+    documents = [db.build_message("hash", "in", f"wamid.{i}", "oi") for i in range(5)]
+    await db.queue_messages(documents[:2])
+    await db.queue_messages(documents[2:])
+    await db.stop_writer()
+
+    assert [document for batch in batches for document in batch] == documents
+    assert db._flush_task is None
+    assert db._pending is None
+
+
+async def test_writer_groups_messages_in_batches(monkeypatch):
+    monkeypatch.setattr(main, "MESSAGE_BATCH_SIZE", 2)
+    db = MongoTriageDatabase()
+    batches = []
+
+    async def fake_save_messages(documents):
+        batches.append(list(documents))
+        return True
+
+    monkeypatch.setattr(db, "save_messages", fake_save_messages)
+    db.start_writer()
+
+    await db.queue_messages([db.build_message("hash", "in", f"wamid.{i}", "oi") for i in range(4)])
+    await asyncio.sleep(main.MESSAGE_FLUSH_INTERVAL * 6)
+    await db.stop_writer()
+
+    assert [len(batch) for batch in batches if batch] == [2, 2]
+
+
+# ================================
+# CACHE DE TRIAGENS
+# ================================
+
+async def test_next_turn_reads_state_merged_before_write(monkeypatch):
+    triages = _BlockingTriages()
+    monkeypatch.setattr(main, "mongo_db", SimpleNamespace(triages=triages))
+    db = MongoTriageDatabase()
+    now = datetime.now()
+    db._cache_triage("hash", {
+        "status": "open",
+        "slots": TriageSlots().model_dump(),
+        "created_at": now,
+        "last_activity": now
+    })
+
+    # Gravação do turno ainda em andamento no MongoDB
+    save = asyncio.create_task(db.save_turn(
+        "hash", [], slots=TriageSlots(chief_complaint="dor de cabeça"), last_activity=now
+    ))
+    await asyncio.sleep(0)
+
+    triage = await db.get_active_triage("hash", now=now, idle_timeout=timedelta(minutes=30))
+
+    assert db.slots_from_triage(triage).chief_complaint == "dor de cabeça"
+    # Servido pelo cache: a única operação no MongoDB é a gravação pendente
+    assert triages.calls == 1
+
+    triages.release.set()
+    assert await save
+    assert db.slots_from_triage(await db.get_active_triage("hash")).chief_complaint == "dor de cabeça"